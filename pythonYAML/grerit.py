@@ -68,11 +68,44 @@ Note:
 """
 import requests
 import argparse
+import asyncio
+import base64
+import concurrent.futures
 import datetime
+import hashlib
+import json
 import os
+import random
+import shlex
+import shutil
 import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
 import time
-from kubernetes import client, config
+import yaml
+from kubernetes import client, config, watch
+from kubernetes.client.rest import ApiException
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Helm home directory, passed explicitly as commands run without a shell
+HELM_HOME = os.path.expandvars('$HOME/.helm')
+
+# Minimum age in seconds of the cached helm repo index before it is updated
+HELM_REPO_UPDATE_INTERVAL = 24 * 60 * 60
+
+# Maximum number of helm releases uninstalled at the same time
+HELM_DELETE_CONCURRENCY = 8
+
+# Larger pipes keep verbose helm --debug output from stalling the child
+# (the pipesize argument needs Python 3.10 or later)
+PIPE_SIZE_OPTIONS = ({'pipesize': 1 << 20}
+                     if sys.version_info >= (3, 10) else {})
 
 
 def valid_file_path(file_path):
@@ -83,7 +116,7 @@ def valid_file_path(file_path):
                                          '" provided is not a readable file')
 
 
-def parse_args():
+def _build_parser():
     parser = argparse.ArgumentParser(
         description='Test tool for HELM installation and upgrade')
     parser.add_argument('-k', '--kubernetes-admin-conf',
@@ -143,7 +176,15 @@ def parse_args():
                             metavar='DOCKER_CONFIG_JSON',
                             help='Path to the config.json containing credentials for Docker')
 
-    args = parser.parse_args()
+    return parser
+
+
+# The parser does not depend on any runtime state, build it only once
+_PARSER = _build_parser()
+
+
+def parse_args(argv=None):
+    args = _PARSER.parse_args(argv)
 
     if (not args.baseline_chart_version) and (not args.skip_upgrade_test):
         raise argparse.ArgumentTypeError(
@@ -163,19 +204,44 @@ def log(*message):
           ': ' + str(*message))
 
 
+def backoff_delay(attempt):
+    # Delay before poll number attempt + 1: exponential backoff starting
+    # at one second and capped at 30 seconds, with a little jitter
+    return min(30.0, 0.5 * (2 ** min(attempt, 6))) + random.random() * 0.25
+
+
+def backoff_sleep(attempt):
+    time.sleep(backoff_delay(attempt))
+
+
+def read_chart_name(chart_archive):
+    # Read the chart name from the top level Chart.yaml of chart_archive,
+    # without going through 'helm inspect chart'
+    with tarfile.open(chart_archive, 'r:gz') as archive:
+        chart_yaml = next((m for m in archive
+                           if m.name.count('/') == 1 and
+                           m.name.endswith('/Chart.yaml')), None)
+        if chart_yaml is None:
+            raise ValueError('No Chart.yaml in ' + chart_archive)
+        return yaml.load(archive.extractfile(chart_yaml),
+                         Loader=SafeLoader)['name']
+
+
 # Earlier we used p.wait and it used to take ages.
 # Now we have removed wait and yet we have checks to see
 # if the command is executed successfully or not
-def execute_command(command):
-    # Execute a command and return stdout, crash in case of a non-zero rc
+def execute_command(argv):
+    # Execute argv without a shell and return stdout, crash in case of a
+    # non-zero rc
     log("<-------------------------------------------------->")
-    log('Command: ' + command )
+    log('Command: ' + shlex.join(argv))
 
-    proc = subprocess.Popen(command,
+    proc = subprocess.Popen(argv,
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE,
-                                shell=True,
-                                universal_newlines=True)
+                                text=True,
+                                encoding='utf-8',
+                                **PIPE_SIZE_OPTIONS)
     std_out, std_err = proc.communicate()
 
     if proc.returncode != 0:
@@ -189,134 +255,283 @@ def execute_command(command):
     return std_out
 
 
+async def execute_command_async(argv):
+    # Execute argv without a shell and return stdout, crash in case of a
+    # non-zero rc. Does not block the event loop while the command runs,
+    # so independent commands can be awaited together.
+    log("<-------------------------------------------------->")
+    log('Command: ' + shlex.join(argv))
+
+    proc = await asyncio.create_subprocess_exec(*argv,
+                                                stdout=subprocess.PIPE,
+                                                stderr=subprocess.PIPE)
+    std_out, std_err = await proc.communicate()
+    std_out = std_out.decode('utf-8')
+
+    if proc.returncode != 0:
+        log("Failed: " + std_err.decode('utf-8'))
+        raise ValueError('Command return unexpected error code: %d' %
+                         proc.returncode)
+    else:
+        log("Success: " + std_out)
+
+    log("<-------------------------------------------------->")
+    return std_out
+
+
+def helm_ls(namespace_name, *flags):
+    # Return the names of the helm releases in namespace_name, filtered by
+    # the given 'helm ls' flags, decoded from the JSON output
+    list_command = (['helm', 'ls'] + list(flags) +
+                    ['--namespace=' + namespace_name, '-o', 'json'])
+    releases = json.loads(execute_command(list_command) or '[]')
+    return [r['name'] for r in releases]
+
+
 def helm_cleanup_namespace(namespace_name):
-    # Delete all releases in a namespace
+    # Delete all releases in a namespace and return their names, a single
+    # 'helm ls' serves as both the existence check and the release list
     log('Cleaning up namespace, deleting all releases in namespace')
-    releases = execute_command('helm ls --all --namespace=' + namespace_name +
-                               ' -q')
-    if not releases:
-        return
-    for release_name in releases.strip().split('\n'):
+    release_names = helm_ls(namespace_name, '--all')
+    if not release_names:
+        return release_names
+
+    # The releases are independent of each other, delete them concurrently,
+    # at most HELM_DELETE_CONCURRENCY at a time. Every delete is awaited
+    # before the first failure is raised, so no helm child is left behind.
+    async def delete_releases():
+        semaphore = asyncio.Semaphore(HELM_DELETE_CONCURRENCY)
+
+        async def delete_release(release_name):
+            async with semaphore:
+                await helm_delete_release_async(release_name, namespace_name)
+
+        results = await asyncio.gather(*[delete_release(release_name)
+                                         for release_name in release_names],
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    for release_name in release_names:
         log('Cleaning up helm release: ' + release_name)
-        helm_delete_release(release_name)
+    asyncio.run(delete_releases())
+    return release_names
 
 
-def helm_delete_release(release_name):
-    # Uninstall release_name in current namespace with a 20000s timeout
+def helm_delete_release(release_name, namespace_name):
+    # Uninstall release_name in namespace_name with a 20000s timeout
     log('Deleting release: ' + release_name)
-    delete_command = ('helm uninstall --debug --timeout=20000s ' +
-                      release_name)
+    delete_command = ['helm', 'uninstall', '--debug', '--timeout=20000s',
+                      '--namespace=' + namespace_name, release_name]
     execute_command(delete_command)
 
 
-def helm_list_releases(namespace_name):
-    # List all helm releases in the namespace
-    list_command = 'helm ls --all --namespace=' + namespace_name
-    execute_command(list_command)
+async def helm_delete_release_async(release_name, namespace_name):
+    # Uninstall release_name in namespace_name like helm_delete_release,
+    # but can run concurrently with others
+    log('Deleting release: ' + release_name)
+    await execute_command_async(['helm', 'uninstall', '--debug',
+                                 '--timeout=20000s',
+                                 '--namespace=' + namespace_name,
+                                 release_name])
 
 
-def helm_release_exist_in_namespace(namespace_name):
-    list_command = 'helm ls --all --namespace=' + namespace_name
-    return bool(execute_command(list_command))
+def helm_list_releases(namespace_name):
+    # List all helm releases in the namespace
+    log('Releases: ' + ', '.join(helm_ls(namespace_name, '--all')))
 
 
 def helm_install_chart_archive(name, chart_archive, namespace_name):
     # Install chart_archive
-    install_command = ('helm install --debug ' + name + ' ' +
-                       chart_archive +
-                       ' --namespace=' + namespace_name +
-                       ' --wait --timeout 20000s')
+    install_command = ['helm', 'install', '--debug', name, chart_archive,
+                       '--namespace=' + namespace_name,
+                       '--wait', '--timeout', '20000s']
     return execute_command(install_command)
 
 
-def helm_install_chart_from_repo(helm_repo, chart_name, chart_version,
-                                 release_name, target_namespace_name):
-    log('Adding helm repo')
-    repo_add_command = ('helm repo add --home=$HOME/.helm'
-                        ' --debug ' + 'BASELINE' + ' ' + helm_repo)
+def helm_update_repo(update_lock=None):
+    # Update the helm repo index and touch update_lock, if given
+    log('Updating the helm repo')
+    repo_add_command = ['helm', 'repo', 'update']
     execute_command(repo_add_command)
+    if update_lock:
+        with open(update_lock, 'a'):
+            os.utime(update_lock)
 
-    log('Updating the helm repo')
-    repo_add_command = ('helm repo update')
+
+def helm_add_repo(helm_repo, update_lock=None):
+    # Add helm_repo as BASELINE and update it, unless update_lock has been
+    # touched within the last HELM_REPO_UPDATE_INTERVAL seconds. Return
+    # True if the index was updated.
+    log('Adding helm repo')
+    repo_add_command = ['helm', 'repo', 'add', '--home=' + HELM_HOME,
+                        '--debug', 'BASELINE', helm_repo]
     execute_command(repo_add_command)
 
+    if update_lock and os.path.isfile(update_lock) and \
+            time.time() - os.path.getmtime(update_lock) < \
+            HELM_REPO_UPDATE_INTERVAL:
+        log('Skipping helm repo update, the index was updated recently')
+        return False
+
+    helm_update_repo(update_lock)
+    return True
+
+
+def helm_fetch_cached_chart(helm_repo, chart_name, chart_version, cache_dir):
+    # Return the path of chart_name-chart_version.tgz in cache_dir, fetching
+    # it from helm_repo first if it has not been cached by an earlier run
+    repo_hash = hashlib.sha1(helm_repo.encode('utf-8')).hexdigest()
+    repo_cache_dir = os.path.join(cache_dir, repo_hash)
+    chart_path = os.path.join(repo_cache_dir,
+                              chart_name + '-' + chart_version + '.tgz')
+    if os.path.isfile(chart_path):
+        log('Using cached chart archive: ' + chart_path)
+        return chart_path
+
+    os.makedirs(repo_cache_dir, exist_ok=True)
+    update_lock = os.path.join(cache_dir, 'index-' + repo_hash + '.lock')
+    index_updated = helm_add_repo(helm_repo, update_lock)
+    # Fetch into a private directory and move the archive into place, so a
+    # concurrent run never sees a partially written archive
+    log('Fetching chart into cache')
+    fetch_dir = tempfile.mkdtemp(dir=repo_cache_dir)
+    try:
+        fetch_command = ['helm', 'fetch', '--debug', 'BASELINE/' + chart_name,
+                         '--version=' + chart_version,
+                         '--destination', fetch_dir]
+        try:
+            execute_command(fetch_command)
+        except ValueError:
+            if index_updated:
+                raise
+            # The skipped update may have missed a recently published
+            # version, update the index and try once more
+            log('Fetching chart failed, retrying with an updated index')
+            helm_update_repo(update_lock)
+            execute_command(fetch_command)
+        fetched_path = os.path.join(fetch_dir, os.path.basename(chart_path))
+        if not os.path.isfile(fetched_path):
+            raise ValueError('helm fetch did not create expected chart '
+                             'archive: ' + os.path.basename(chart_path))
+        os.replace(fetched_path, chart_path)
+    finally:
+        shutil.rmtree(fetch_dir, ignore_errors=True)
+    return chart_path
+
+
+def helm_install_chart_from_repo(helm_repo, chart_name, chart_version,
+                                 release_name, target_namespace_name):
+    # Install the baseline chart, from the chart cache when HELM_CHART_CACHE
+    # points to a cache directory, directly from helm_repo otherwise
+    cache_dir = os.environ.get('HELM_CHART_CACHE')
+    if cache_dir:
+        chart = helm_fetch_cached_chart(helm_repo, chart_name, chart_version,
+                                        os.path.expanduser(
+                                            os.path.expandvars(cache_dir)))
+        version_options = []
+    else:
+        helm_add_repo(helm_repo)
+        chart = 'BASELINE/' + chart_name
+        version_options = ['--version=' + chart_version]
+
     log('Installing chart')
-    baseline_install_command = ('helm install --home=$HOME/.helm '
-                                '  --debug --namespace=' +  target_namespace_name +
-                                '     BASELINE/' + chart_name + ' '
-                                '  --version=' + chart_version +
-                                '  --wait --timeout 20000s' +
-                                '  --name=' + release_name)
+    baseline_install_command = (['helm', 'install', '--home=' + HELM_HOME,
+                                 '--debug',
+                                 '--namespace=' + target_namespace_name,
+                                 chart] +
+                                version_options +
+                                ['--wait', '--timeout', '20000s',
+                                 '--name=' + release_name])
     execute_command(baseline_install_command)
 
 
 def helm_wait_for_deployed_release_to_appear(expected_release_name,
-                                             target_namespace_name):
+                                             target_namespace_name,
+                                             timeout=300):
     # Wait for helm release to appear on the list and exit with None,
-    # or raise ValueError if timeout of counter*sleep seconds
+    # or raise ValueError after timeout seconds
     log('Waiting for helm release to reach deployed state')
-    counter = 20
+    deadline = time.monotonic() + timeout
+    attempt = 0
     while True:
-        release_name = execute_command('helm ls --deployed ' + ' --namespace=' +
-                                        target_namespace_name + ' -q').rstrip()
-        if release_name == expected_release_name:
+        release_names = helm_ls(target_namespace_name, '--deployed')
+        if expected_release_name in release_names:
             return
-        log('%s != %s' % (str(release_name), expected_release_name))
-        if counter > 0:
-            counter = counter - 1
-            time.sleep(15)
-        else:
+        log('%s not in %s' % (expected_release_name, str(release_names)))
+        if time.monotonic() > deadline:
             raise ValueError('Timeout waiting for release to reach '
                              ' deployed state')
+        attempt += 1
+        backoff_sleep(attempt)
 
 
 def helm_upgrade_with_chart_archive(baseline_release_name, chart_archive,
                                     target_namespace_name):
-    release_name = execute_command('helm ls --deployed ' + baseline_release_name +
-                                   '  --namespace=' + target_namespace_name + ' -q').rstrip()
-
-    if not release_name or release_name != baseline_release_name:
+    if baseline_release_name not in helm_ls(target_namespace_name,
+                                            '--deployed'):
         raise ValueError('Unable to find expected baseline release: ' +
                          baseline_release_name)
 
-    upgrade_command = ('helm upgrade %s %s --namespace %s --debug --wait '
-                       '    --timeout 20000' % (baseline_release_name,
-                                            chart_archive,
-                                            target_namespace_name))
+    upgrade_command = ['helm', 'upgrade', baseline_release_name,
+                       chart_archive, '--namespace', target_namespace_name,
+                       '--debug', '--wait', '--timeout', '20000']
     execute_command(upgrade_command)
 
-def create_secret(namespace, secret_name, config_file_path):
-    # Create k8s secret 'armdocker' in namspace to hold docker config
-    # and configure to pull images from armdocker
-    create_secret_command = ('kubectl create secret generic ' + secret_name +
-                             '  --from-file=.dockerconfigjson=' + config_file_path +
-                             '  --type=kubernetes.io/dockerconfigjson '+
-                             '  --namespace ' + namespace)
-
-    execute_command(create_secret_command).rstrip()
-
-    patch_service_account_command = ('kubectl patch serviceaccount default ' +
-                                     '  -p \'{\"imagePullSecrets\": [{\"name\": \"armdocker\"}]}\'' +
-                                     '  -n ' + namespace)
-
-    execute_command(patch_service_account_command)
-
 
 class KubernetesClient:
     def __init__(self, kubernetes_admin_conf):
         config.load_kube_config(config_file=kubernetes_admin_conf)
-        self.core_v1 = client.CoreV1Api()
-        self.apps_v1 = client.AppsV1beta2Api()
+        # Share one ApiClient between all APIs so every call reuses the
+        # same pool of persistent connections to the apiserver
+        configuration = client.Configuration.get_default_copy()
+        configuration.connection_pool_maxsize = 32
+        self.api_client = client.ApiClient(configuration=configuration)
+        self.core_v1 = client.CoreV1Api(self.api_client)
+        self.apps_v1 = client.AppsV1Api(self.api_client)
+
+    def create_secret(self, namespace, secret_name, config_file_path,
+                      timeout=60):
+        # Create k8s secret 'secret_name' in namespace to hold docker config
+        # and configure the default service account to pull images with it
+        with open(os.path.expandvars(config_file_path), 'rb') as f:
+            docker_config = base64.b64encode(f.read()).decode('ascii')
+        v1secret = client.V1Secret()
+        v1secret.metadata = {'name': secret_name}
+        v1secret.type = 'kubernetes.io/dockerconfigjson'
+        v1secret.data = {'.dockerconfigjson': docker_config}
+        self.core_v1.create_namespaced_secret(namespace=namespace,
+                                              body=v1secret)
+
+        # The serviceaccount controller creates the default service account
+        # asynchronously after the namespace, so retry the patch with
+        # backoff while it does not exist yet, for up to timeout seconds
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        while True:
+            try:
+                self.core_v1.patch_namespaced_service_account(
+                    name='default', namespace=namespace,
+                    body={'imagePullSecrets': [{'name': secret_name}]})
+                return
+            except ApiException as e:
+                if e.status != 404 or time.monotonic() > deadline:
+                    raise
+            log('Waiting for default service account in namespace ' +
+                namespace)
+            attempt += 1
+            backoff_sleep(attempt)
 
     def find_namespace(self, namespace_name):
         # Find namespace and return name of namespace if it exists,
         # None otherwise
-        v1_namespace_list = self.core_v1.list_namespace()
-        # for i in v1_namespace_list.items:
-        #     print(i.metadata.name)
-
-        return next(filter(lambda x: x.metadata.name == namespace_name,
-                           v1_namespace_list.items), None)
+        try:
+            return self.core_v1.read_namespace(name=namespace_name)
+        except ApiException as e:
+            if e.status == 404:
+                return None
+            raise
 
     def create_namespace(self, namespace_name):
         # Create namespace with name "namespace_name" and return namespace
@@ -329,33 +544,109 @@ class KubernetesClient:
         return namespace_item
 
     def delete_namespace(self, namespace_name):
-        # Delete k8s namespace
-        self.core_v1.delete_namespace(name=namespace_name,
-                                      body=client.V1DeleteOptions(),
-                                      propagation_policy='foreground')
-
-    def wait_for_namespace_to_be_deleted(self, namespace_name):
-        # Wait for namespace to be deleted for count*sleep seconds,
-        # else timeout with ValueError
-        counter = 60
+        # Delete k8s namespace, return False if it did not exist
+        try:
+            self.core_v1.delete_namespace(name=namespace_name,
+                                          body=client.V1DeleteOptions(),
+                                          propagation_policy='foreground')
+        except ApiException as e:
+            if e.status == 404:
+                return False
+            raise
+        return True
+
+    def wait_for_namespace_to_be_deleted(self, namespace_name,
+                                         timeout_seconds=900):
+        # Watch namespace until it is deleted for timeout_seconds,
+        # else timeout with ValueError. The namespace is listed again and
+        # the watch restarted if the stream ends early or its
+        # resourceVersion has expired (410 Gone).
+        field_selector = 'metadata.name=' + namespace_name
+        deadline = time.monotonic() + timeout_seconds
         while True:
-            if not self.find_namespace(namespace_name):
-                break
-            if counter > 0:
-                log('Waiting for namespace %s to be deleted.' % namespace_name)
-                counter = counter - 1
-                time.sleep(15)
-            else:
+            v1_namespace_list = self.core_v1.list_namespace(
+                field_selector=field_selector)
+            if not v1_namespace_list.items:
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
                 raise ValueError('Timeout waiting for namespace %s to be '
                                  'deleted.' % namespace_name)
+            log('Waiting for namespace %s to be deleted.' % namespace_name)
+            resource_version = v1_namespace_list.metadata.resource_version
+            w = watch.Watch()
+            try:
+                for event in w.stream(
+                        self.core_v1.list_namespace,
+                        field_selector=field_selector,
+                        resource_version=resource_version,
+                        timeout_seconds=max(1, int(remaining))):
+                    if event['type'] == 'DELETED':
+                        return
+            except ApiException as e:
+                if e.status != 410:
+                    raise
+            finally:
+                w.stop()
 
     def wait_for_all_resources(self, namespace_name):
         # Wait for all resources to be up and running
         self.wait_for_all_pods_to_start(namespace_name)
-        self.wait_for_all_api_resources(namespace_name, "replicaset")
-        self.wait_for_all_api_resources(namespace_name, "deployment")
-
-    def wait_for_all_pods_to_start(self, namespace_name):
+        # Replicasets and deployments are independent, poll them together
+        # over the shared connection pool. The first wait to fail cancels
+        # the other one, so its error is raised without waiting for the
+        # other's timeout.
+        cancelled = threading.Event()
+
+        def wait_for_api_resources(api_resource):
+            try:
+                return self.wait_for_all_api_resources(namespace_name,
+                                                       api_resource,
+                                                       cancelled=cancelled)
+            except BaseException:
+                cancelled.set()
+                raise
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(wait_for_api_resources, api_resource)
+                       for api_resource in ("replicaset", "deployment")]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+
+    def _watch_pods(self, namespace_name, timeout_seconds):
+        # Yield the pods in namespace_name keyed by pod name, once for every
+        # listing and then again after every watch event, until
+        # timeout_seconds have passed. The pods are listed again and the
+        # watch restarted if the stream ends early or its resourceVersion
+        # has expired (410 Gone).
+        deadline = time.monotonic() + timeout_seconds
+        while True:
+            api_response = self.core_v1.list_namespaced_pod(namespace_name)
+            pods = {i.metadata.name: i for i in api_response.items}
+            yield pods
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            resource_version = api_response.metadata.resource_version
+            w = watch.Watch()
+            try:
+                for event in w.stream(
+                        self.core_v1.list_namespaced_pod, namespace_name,
+                        resource_version=resource_version,
+                        timeout_seconds=max(1, int(remaining))):
+                    pod = event['object']
+                    if event['type'] == 'DELETED':
+                        pods.pop(pod.metadata.name, None)
+                    else:
+                        pods[pod.metadata.name] = pod
+                    yield pods
+            except ApiException as e:
+                if e.status != 410:
+                    raise
+            finally:
+                w.stop()
+
+    def wait_for_all_pods_to_start(self, namespace_name, timeout_seconds=900):
         # Raise an error if all pods not running, else exit with a None
         def format_containers(i):
             if not i.status.container_statuses:
@@ -368,93 +659,97 @@ class KubernetesClient:
                                str(c.state.waiting).replace('\n', ''))
                               for c in i.status.container_statuses])
 
+        def pod_state(i):
+            return (i.metadata.name, i.status.phase,
+                    tuple(cs.ready for cs in
+                          (i.status.container_statuses or ())))
+
+        def expected_pods():
+            return sum(
+                d.spec.replicas or 0 for d in
+                self.apps_v1.list_namespaced_deployment(namespace_name).items)
+
         log('Pods:')
-        counter = 60
-        while True:
-            api_response = self.core_v1.list_namespaced_pod(namespace_name)
-            log('\n'.join(['\nPodname: %s'
-                           '\n    Phase: %s'
-                           '\n    Containers: %s' %
-                           (i.metadata.name, i.status.phase,
-                            format_containers(i))
-                           for i in api_response.items]))
-
-            if all([i.status.phase == 'Running' and
-                    all([cs.ready for cs in i.status.container_statuses])
-                    for i in api_response.items]):
-                break
-            if counter > 0:
-                counter = counter - 1
-                time.sleep(15)
-            else:
-                raise ValueError('Timeout waiting for pods to reach '
-                                 'Ready & Running')
-
-    def wait_for_all_pods_to_terminate(self, namespace_name):
+        prev_state = None
+        for pods in self._watch_pods(namespace_name, timeout_seconds):
+            # Only log the pods when one of them changed phase or readiness
+            state = tuple(pod_state(i) for i in pods.values())
+            if state != prev_state:
+                prev_state = state
+                log('\n'.join(['\nPodname: %s'
+                               '\n    Phase: %s'
+                               '\n    Containers: %s' %
+                               (i.metadata.name, i.status.phase,
+                                format_containers(i))
+                               for i in pods.values()]))
+
+            # A partial pod list is not a success while deployments still
+            # have pods to create. The deployments are only counted once
+            # every known pod is ready, so that deployments created
+            # meanwhile are included. Charts without any pods pass at once.
+            if all(i.status.phase == 'Running' and
+                   all(cs.ready for cs in
+                       (i.status.container_statuses or ()))
+                   for i in pods.values()) and \
+                    len(pods) >= expected_pods():
+                return
+        raise ValueError('Timeout waiting for pods to reach '
+                         'Ready & Running')
+
+    def wait_for_all_pods_to_terminate(self, namespace_name,
+                                       timeout_seconds=900):
         # Print pod status, if no pods listed then break out
         # Raise error if pop termination times out
         log('Pods:')
-        counter = 60
-        while True:
-            api_response = self.core_v1.list_namespaced_pod(namespace_name)
-            if not api_response.items:
-                break
-            else:
-                log('\n'.join(['\nPhase: %s  Podname: %s' %
-                               (i.status.phase, i.metadata.name)
-                               for i in api_response.items]))
-
-            if counter > 0:
-                counter = counter - 1
-                time.sleep(15)
-            else:
-                raise ValueError('Timeout waiting for pods to terminate')
-
-    def _get_name_actual_desired(self, output_line, api_resource):
+        for pods in self._watch_pods(namespace_name, timeout_seconds):
+            if not pods:
+                return
+            log('\n'.join(['\nPhase: %s  Podname: %s' %
+                           (i.status.phase, i.metadata.name)
+                           for i in pods.values()]))
+        raise ValueError('Timeout waiting for pods to terminate')
+
+    def _list_api_resource(self, namespace, api_resource):
         if api_resource == "deployment":
-            name = output_line[0]
-            actual = int(output_line[1].split("/")[0])
-            expected = int(output_line[1].split("/")[1])
+            return self.apps_v1.list_namespaced_deployment(namespace).items
         elif api_resource == "replicaset":
-            name = output_line[0]
-            actual = int(output_line[2])
-            expected = int(output_line[1])
-        return name, actual, expected
+            return self.apps_v1.list_namespaced_replica_set(namespace).items
 
     def wait_for_all_api_resources(self, namespace, api_resource,
-                                   sleep=15, retries=20):
-        # Wait for all pods in api_resoruce to be running
+                                   timeout=300, cancelled=None):
+        # Wait for all pods in api_resoruce to be running, raise
+        # TimeoutError if they are not within timeout seconds. Gives up
+        # and returns False as soon as the cancelled event is set.
+        deadline = time.monotonic() + timeout
         attempt = 1
-        count = 0
         while True:
-            response = execute_command(
-                "kubectl get " + api_resource + " --no-headers -n " + namespace
-            ).splitlines()
-
-            log('TRY(%s/%s)  %ss:' %
-                (str(attempt).zfill(len(str(retries))),
-                 str(retries),
-                 api_resource)
-            )
-            total = len(response)
+            response = self._list_api_resource(namespace, api_resource)
+
+            log('TRY(%s)  %ss:' % (str(attempt), api_resource))
+            ready = True
             for resource in response:
-                resource = resource.split()
-                name, actual, expected = self._get_name_actual_desired(
-                    resource, api_resource
-                )
+                # Deployments count ready pods like kubectl's READY column,
+                # replicasets count created pods like its CURRENT column
+                if api_resource == "deployment":
+                    actual = resource.status.ready_replicas or 0
+                else:
+                    actual = resource.status.replicas or 0
+                expected = resource.spec.replicas or 0
                 log("%s: Pods ready/desired: (%d/%d)" %
-                    (name, actual, expected))
+                    (resource.metadata.name, actual, expected))
 
                 if actual != expected:
-                    attempt += 1
-                    if attempt > retries:
-                        raise TimeoutError("Retries exceeded")
-                    time.sleep(sleep)
-                    count = 0
+                    ready = False
                     break
-                count += 1
-            if count == total:
+            if ready:
                 return True
+            if time.monotonic() > deadline:
+                raise TimeoutError("Retries exceeded")
+            if cancelled is None:
+                backoff_sleep(attempt)
+            elif cancelled.wait(backoff_delay(attempt)):
+                return False
+            attempt += 1
 
 def main():
     args = parse_args()
@@ -463,13 +758,7 @@ def main():
     release_name = args.helm_release_name
 
     # Deduct a "chart_name" for using it as part of a release name.
-    # Takes the chart archive and does a 'helm inspect chart' on it
-    # takes the value part of the name (after the space) from the line
-    # starting with 'name: '
-    chart_name = list(filter(lambda x: x.startswith('name: '),
-                             execute_command('helm inspect chart ' +
-                                             chart_archive
-                                             ).split('\n')))[0].split(' ')[1]
+    chart_name = read_chart_name(chart_archive)
 
     helm_repo = args.helm_repo
     baseline_chart_version = args.baseline_chart_version
@@ -480,12 +769,9 @@ def main():
         # Cleanup namespace by removing releases, pods and
         # deleting the namespace
         log('Ensure that target namespace has been cleaned up')
-        namespace_item = kube.find_namespace(target_namespace_name)
-        if namespace_item:
-            if helm_release_exist_in_namespace(target_namespace_name):
-                helm_cleanup_namespace(target_namespace_name)
-                kube.wait_for_all_pods_to_terminate(target_namespace_name)
-            kube.delete_namespace(target_namespace_name)
+        if helm_cleanup_namespace(target_namespace_name):
+            kube.wait_for_all_pods_to_terminate(target_namespace_name)
+        if kube.delete_namespace(target_namespace_name):
             kube.wait_for_namespace_to_be_deleted(target_namespace_name)
 
     def test_setup():
@@ -493,7 +779,8 @@ def main():
         log('Setup 1: Ensure that target namespace exists')
         kube.create_namespace(target_namespace_name)
 
-        create_secret(target_namespace_name, 'armdocker', args.config_json)
+        kube.create_secret(target_namespace_name, 'armdocker',
+                           args.config_json)
 
         if args.dependency_chart_archive:
             log('Setup 2: Install dependency chart archive')
@@ -509,7 +796,7 @@ def main():
     def test_teardown():
         if args.dependency_chart_archive:
             log('Teardown: Delete dependency release')
-            helm_delete_release('dependency-release')
+            helm_delete_release('dependency-release', target_namespace_name)
         cleanup_target_namespace()
 
     def test_install():
@@ -531,7 +818,7 @@ def main():
                                                  target_namespace_name)
 
         log('Test Step 4: Delete release - %s' % d(t))
-        helm_delete_release(release_name)
+        helm_delete_release(release_name, target_namespace_name)
 
     def test_upgrade():
         # TODO
@@ -567,8 +854,8 @@ def main():
         # if not upgrade_status:
         #     log('Upgrade failed performing rollback')
         #     default_revision_number = '1'
-        #     rollback_command = ("helm rollback " + chart_name +
-        #                         " " + default_revision_number + " --wait ")
+        #     rollback_command = ['helm', 'rollback', chart_name,
+        #                         default_revision_number, '--wait']
         #     execute_command(rollback_command)
         #     return
 